@@ -7,6 +7,11 @@ import logging.handlers
 import queue
 import datetime
 import re
+import threading
+import collections
+import sqlite3
+import csv
+import struct
 from fatsecret import Fatsecret
 from PyQt5.QtCore import (QObject, QThread, pyqtSlot, pyqtSignal, Qt)
 from PyQt5.QtWidgets import (QWidget, QLabel, QMessageBox, QListWidget,
@@ -33,6 +38,9 @@ class PiFoodScale(QWidget):
         self.currentServingName = None
         self.currentServingId = None
         self.currentFoodEntry = None
+        # bumped on every selection change, stale onFood results are
+        # ignored
+        self.selectionCount = 0
 
         self.scaleThread = QThread()
         self.scaleReader = ReadScale(self.config)
@@ -49,6 +57,7 @@ class PiFoodScale(QWidget):
         self.fatsecret.onEntries[dict].connect(self.onEntries)
         self.fatsecret.onFoodEntryCreate[dict].connect(self.onFoodEntryCreate)
         self.fatsecret.onFoodEntryDelete[dict].connect(self.onFoodEntryDelete)
+        self.fatsecret.onFood[dict].connect(self.onFood)
         self.fatsecret.moveToThread(self.fsThread)
         self.fsThread.started.connect(self.fatsecret.run)
         self.fsThread.start()
@@ -160,6 +169,11 @@ class PiFoodScale(QWidget):
         self.show()
         # self.showFullScreen()
 
+    def closeEvent(self, event):
+        if self.scaleReader.telemetry is not None:
+            self.scaleReader.telemetry.stop()
+        super().closeEvent(event)
+
     def checkError(self, result):
         if 'error' in result:
             QMessageBox.critical(None, "Fatsecret exception",
@@ -168,17 +182,19 @@ class PiFoodScale(QWidget):
 
     def doAdd(self):
         self.fatsecret.q.put({'func': 'food_entry_create',
-                              'food_id': self.currentFood['food_id'],
+                              'food_id': self.currentFood.foodId,
                               'date': datetime.datetime.now(),
                               'food_entry_name': self.lblName.text(),
                               'serving_id': self.currentServingId,
                               'number_of_units': self.currentServingAmount,
+                              'grams': float(self.txtAmount.text()),
                               'meal': 'other'})
         self.currentFood = None
         self.currentServingId = None
         self.currentServingName = None
         self.currentServingAmount = None
         self.currentFoodEntry = None
+        self.selectionCount += 1
         self.doCompute()
 
     def doDel(self):
@@ -189,6 +205,7 @@ class PiFoodScale(QWidget):
         self.currentServingName = None
         self.currentServingAmount = None
         self.currentFoodEntry = None
+        self.selectionCount += 1
         self.doCompute()
 
     def doRefresh(self):
@@ -241,29 +258,23 @@ class PiFoodScale(QWidget):
             return
 
         wgt = float(self.txtAmount.text())
-        servings = self.currentFood['servings']
-        if type(servings) is dict:
-            servings = servings['serving']
-        if type(servings) is dict:
-            servings = [servings]
-        serving = servings[0]
+        serving = self.currentFood.servings[0]
         logging.info(serving)
-        samt = float(serving['metric_serving_amount'])
-        sfact = wgt / samt
+        sfact = wgt / serving.metricAmount
         logging.info('sfact=%f', sfact)
-        calories = float(serving['calories']) * sfact
-        carbs = float(serving['carbohydrate']) * sfact
-        protein = float(serving['protein']) * sfact
-        fat = float(serving['fat']) * sfact
+        calories = serving.calories * wgt
+        carbs = serving.carbohydrate * wgt
+        protein = serving.protein * wgt
+        fat = serving.fat * wgt
         self.lblCalories.setText("%.1f" % calories)
         self.lblCarbs.setText("%.1f" % carbs)
         self.lblProtein.setText("%.1f" % protein)
         self.lblFat.setText("%.1f" % fat)
         self.currentServingAmount = sfact
-        self.currentServingName = serving['serving_description']
+        self.currentServingName = serving.description
         self.lblServing.setText(self.currentServingName)
         self.lblServingAmount.setText("%.2f" % self.currentServingAmount)
-        self.currentServingId = serving['serving_id']
+        self.currentServingId = serving.servingId
         self.btnAdd.setEnabled(True)
         logging.info('current food entry = %s', self.currentFoodEntry)
         if self.currentFoodEntry is not None:
@@ -280,27 +291,58 @@ class PiFoodScale(QWidget):
     @pyqtSlot(QListWidgetItem)
     def eatenClick(self, item):
         logging.info('eaten click %s %s', item.text(), item.data(Qt.UserRole))
-        self.lblName.setText(item.text())
-        self.currentFood = self.fatsecret.foods[item.data(Qt.UserRole)]
-        self.currentFoodEntry = None
-        self.doCompute()
+        self.selectFood({'food_id': item.data(Qt.UserRole),
+                         'name': item.text(),
+                         'amount': None,
+                         'food_entry_id': None})
 
     @pyqtSlot(QTableWidgetItem)
     def todayClick(self, item):
         logging.info('today click %s %s', item.text(), item.data(Qt.UserRole))
-        self.currentFood = self.fatsecret.foods[item.data(Qt.UserRole)]
-        s = ''
-        if 'brand_name' in self.currentFood:
-            s = self.currentFood['brand_name'] + ' '
-        s = s + self.currentFood['food_name']
-        self.lblName.setText(s)
-        self.currentServingAmount = item.data(Qt.UserRole+1)
-        if self.currentServingAmount[-1:] == 'g':
-            self.currentServingAmount = self.currentServingAmount[:-1]
-        self.currentFoodEntry = item.data(Qt.UserRole+2)
-        self.txtAmount.setText(self.currentServingAmount)
+        self.selectFood({'food_id': item.data(Qt.UserRole),
+                         'name': None,
+                         'amount': item.data(Qt.UserRole+1),
+                         'food_entry_id': item.data(Qt.UserRole+2)})
+
+    def selectFood(self, selection):
+        self.selectionCount += 1
+        selection['count'] = self.selectionCount
+        food = self.fatsecret.foods.get(selection['food_id'])
+        if food is None:
+            # evicted from the store, fetch just this one and select it
+            # when it arrives in onFood
+            logging.info('food %s not in store, fetching',
+                         selection['food_id'])
+            self.fatsecret.q.put({'func': 'food_get',
+                                  'food_id': selection['food_id'],
+                                  'selection': selection})
+            return
+        self.showFood(food, selection)
+
+    def showFood(self, food, selection):
+        self.currentFood = food
+        if selection['name'] is not None:
+            self.lblName.setText(selection['name'])
+        else:
+            self.lblName.setText(food.displayName())
+        self.currentFoodEntry = selection['food_entry_id']
+        if selection['amount'] is not None:
+            self.currentServingAmount = selection['amount']
+            if self.currentServingAmount[-1:] == 'g':
+                self.currentServingAmount = self.currentServingAmount[:-1]
+            self.txtAmount.setText(self.currentServingAmount)
         self.doCompute()
 
+    @pyqtSlot(dict)
+    def onFood(self, result):
+        logging.info("onFood result = %s", result)
+        if result['selection']['count'] != self.selectionCount:
+            logging.info('onFood selection changed, ignoring')
+            return
+        if self.checkError(result):
+            return
+        self.showFood(result['data'], result['selection'])
+
     @pyqtSlot(dict)
     def onLogin(self, result):
         logging.info("onLogin result = %s", result)
@@ -322,12 +364,8 @@ class PiFoodScale(QWidget):
             return
         self.listEaten.clear()
         for f in result['data']:
-            s = ''
-            if 'brand_name' in f:
-                s = f['brand_name'] + ' '
-            s = s + f['food_name']
-            qi = QListWidgetItem(s)
-            qi.setData(Qt.UserRole, f['food_id'])
+            qi = QListWidgetItem(f.displayName())
+            qi.setData(Qt.UserRole, f.foodId)
             self.listEaten.addItem(qi)
 
     @pyqtSlot(dict)
@@ -350,27 +388,18 @@ class PiFoodScale(QWidget):
             i = i + 1
             food = f['food']
             entry = f['entry']
-            s = ''
-            if 'brand_name' in food:
-                s = food['brand_name'] + ' '
-            s = s + food['food_name']
-            qi = QTableWidgetItem(s)
+            qi = QTableWidgetItem(food.displayName())
             qi.setFlags(Qt.ItemIsSelectable | Qt.ItemIsEnabled)
             # qi.setData(Qt.UserRole, f['food_id'])
             self.tableToday.setItem(i, 0, qi)
             if 'number_of_units' in entry:
                 q = float(entry['number_of_units'])
                 qs = str(q)
-                servid = entry['serving_id']
-                servings = food['servings']['serving']
-                if type(servings) is dict:
-                    servings = [servings]
-                for serv in servings:
-                    if serv['serving_id'] == servid:
-                        su = serv['metric_serving_unit']
-                        sa = serv['metric_serving_amount']
-                        sn = serv['number_of_units']
-                        qs = "{0:.1f}".format(q * float(sa) / float(sn)) + su
+                serv = food.serving(entry['serving_id'])
+                if serv is not None:
+                    qs = "{0:.1f}".format(
+                        q * serv.metricAmount / serv.numberOfUnits)
+                    qs = qs + serv.metricUnit
                 qi.setData(Qt.UserRole, entry['food_id'])
                 qi.setData(Qt.UserRole+1, qs)
                 qi.setData(Qt.UserRole+2, entry['food_entry_id'])
@@ -458,9 +487,21 @@ class ReadScale(QObject):
         self.neg = False
         self.predisp = ''
         self.disp = '???'
+        self.telemetry = None
         self.emitValue()
+        # started after the initial emitValue, so only readings from the
+        # scale are recorded
+        tconfig = config.config['Telemetry']
+        if tconfig['Enabled']:
+            self.telemetry = Telemetry(tconfig['Filename'],
+                                       tconfig['BufferSize'],
+                                       tconfig['FlushInterval'],
+                                       tconfig['MaxFileBytes'])
+            self.telemetry.start()
 
     def emitValue(self):
+        if self.telemetry is not None:
+            self.telemetry.record(self.value, self.neg, self.zero, self.oz)
         self.disp = ""
         if not self.zero:
             if self.neg:
@@ -531,6 +572,212 @@ class ReadScale(QObject):
                 time.sleep(0.1)
 
 
+class Telemetry():
+    # raw scale readings go into a ring buffer (never blocks the reader,
+    # oldest readings are dropped if the writer falls behind) and are
+    # flushed in batches to append-only files of fixed size records:
+    #   <filename>          raw: time, value, flags
+    #   <filename>.1s       per second: time, min, max, mean grams, count
+    #   <filename>.60s      per minute: same as above
+    # the raw and 1s files are moved to <name>.old once they would grow
+    # past maxFileBytes, replacing the previous .old, so only the 60s
+    # tier is kept for good.
+    # times never go backwards in the files: after a clock step back
+    # (no rtc, fake-hwclock, ntp) readings are stamped with the last
+    # written time until the clock catches up again.
+
+    rawRecord = struct.Struct('<dHB')
+    tierRecord = struct.Struct('<dfffI')
+    tiers = (1, 60)
+    keepTiers = (60,)
+
+    NEG = 1
+    ZERO = 2
+    OZ = 4
+
+    def __init__(self, filename="PiFoodScale.telemetry", bufferSize=10000,
+                 flushInterval=5.0, maxFileBytes=20000000):
+        self.filename = filename
+        self.flushInterval = flushInterval
+        self.maxFileBytes = maxFileBytes
+        self.buffer = collections.deque(maxlen=bufferSize)
+        self.buckets = {}
+        self.stopping = threading.Event()
+        self.thread = None
+        self.repair()
+        self.lastTime = self.lastWritten()
+
+    def tierName(self, seconds):
+        return '%s.%ds' % (self.filename, seconds)
+
+    def files(self):
+        names = [(self.filename, self.rawRecord)]
+        names += [(self.tierName(t), self.tierRecord) for t in self.tiers]
+        for name, rec in names:
+            for n in (name + '.old', name):
+                if os.path.exists(n):
+                    yield n, rec
+
+    def repair(self):
+        # a write cut short by power loss leaves a partial record at the
+        # end, which would shift every record appended after it
+        for n, rec in self.files():
+            size = os.path.getsize(n)
+            if size % rec.size:
+                logging.info('telemetry %s truncating %d partial bytes',
+                             n, size % rec.size)
+                os.truncate(n, size - size % rec.size)
+
+    def lastWritten(self):
+        last = None
+        for n, rec in self.files():
+            count = os.path.getsize(n) // rec.size
+            if count == 0:
+                continue
+            with open(n, 'rb') as f:
+                f.seek((count - 1) * rec.size)
+                t = struct.unpack('<d', f.read(8))[0]
+            if last is None or t > last:
+                last = t
+        return last
+
+    def record(self, value, neg, zero, oz):
+        flags = ((self.NEG if neg else 0) | (self.ZERO if zero else 0) |
+                 (self.OZ if oz else 0))
+        self.buffer.append((time.time(), value, flags))
+
+    @classmethod
+    def grams(cls, value, flags):
+        if flags & cls.ZERO:
+            return 0.0
+        g = float(value)
+        if flags & cls.OZ:
+            g = g / 10.0 * 28.3495
+        if flags & cls.NEG:
+            g = -g
+        return g
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stopping.set()
+        if self.thread is not None:
+            self.thread.join()
+
+    def run(self):
+        while not self.stopping.wait(self.flushInterval):
+            try:
+                self.flush()
+            except Exception:
+                logging.exception('Telemetry flush exception:')
+        self.flush(final=True)
+
+    def flush(self, final=False):
+        rows = []
+        while True:
+            try:
+                t, value, flags = self.buffer.popleft()
+            except IndexError:
+                break
+            if self.lastTime is not None and t < self.lastTime:
+                t = self.lastTime
+            self.lastTime = t
+            rows.append((t, value, flags))
+        tierRows = dict((t, []) for t in self.tiers)
+        for t, value, flags in rows:
+            g = self.grams(value, flags)
+            for seconds in self.tiers:
+                start = t - t % seconds
+                b = self.buckets.get(seconds)
+                if b is not None and b[0] != start:
+                    tierRows[seconds].append(b)
+                    b = None
+                if b is None:
+                    b = [start, g, g, 0.0, 0]
+                    self.buckets[seconds] = b
+                b[1] = min(b[1], g)
+                b[2] = max(b[2], g)
+                b[3] += g
+                b[4] += 1
+        if final:
+            # partial buckets, a restart within the same bucket writes
+            # another row with the same time, query() merges them
+            for seconds, b in self.buckets.items():
+                tierRows[seconds].append(b)
+            self.buckets = {}
+        if rows:
+            self.append(self.filename,
+                        b''.join(self.rawRecord.pack(*r) for r in rows),
+                        self.maxFileBytes)
+        for seconds, bs in tierRows.items():
+            if bs:
+                limit = self.maxFileBytes
+                if seconds in self.keepTiers:
+                    limit = None
+                self.append(self.tierName(seconds), b''.join(
+                    self.tierRecord.pack(b[0], b[1], b[2], b[3] / b[4],
+                                         b[4]) for b in bs), limit)
+
+    def append(self, filename, data, limit):
+        if (limit and os.path.exists(filename) and
+                os.path.getsize(filename) + len(data) > limit):
+            os.replace(filename, filename + '.old')
+        with open(filename, 'ab') as f:
+            f.write(data)
+
+    def query(self, start, end, resolution=0):
+        # readings with start <= time < end, from the raw file or the
+        # coarsest tier no coarser than resolution seconds
+        filename = self.filename
+        rec = self.rawRecord
+        for seconds in self.tiers:
+            if seconds <= resolution:
+                filename = self.tierName(seconds)
+                rec = self.tierRecord
+        rows = []
+        for name in (filename + '.old', filename):
+            rows.extend(self.readRange(name, rec, start, end))
+        if rec is self.rawRecord:
+            return [(t, self.grams(v, fl), v, fl) for t, v, fl in rows]
+        merged = []
+        for row in rows:
+            if merged and merged[-1][0] == row[0]:
+                t, mn, mx, mean, count = merged[-1]
+                total = mean * count + row[3] * row[4]
+                count += row[4]
+                merged[-1] = (t, min(mn, row[1]), max(mx, row[2]),
+                              total / count, count)
+            else:
+                merged.append(row)
+        return merged
+
+    def readRange(self, filename, rec, start, end):
+        if not os.path.exists(filename):
+            return []
+        with open(filename, 'rb') as f:
+            count = os.path.getsize(filename) // rec.size
+            first = self.search(f, rec, count, start)
+            last = self.search(f, rec, count, end)
+            f.seek(first * rec.size)
+            data = f.read((last - first) * rec.size)
+        return list(rec.iter_unpack(data))
+
+    @staticmethod
+    def search(f, rec, count, t):
+        # first record index with time >= t, records are in time order
+        lo, hi = 0, count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            f.seek(mid * rec.size)
+            if struct.unpack('<d', f.read(8))[0] < t:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+
 class LogHandler(logging.handlers.RotatingFileHandler):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
@@ -551,6 +798,303 @@ class Config():
         self.config.merge(yaml.load(open("Config.yaml", "r")))
 
 
+class Serving():
+    # nutrient values are per gram (or ml) of metric serving
+    __slots__ = ('servingId', 'description', 'metricAmount', 'metricUnit',
+                 'numberOfUnits', 'calories', 'carbohydrate', 'protein',
+                 'fat')
+
+    def __init__(self, s):
+        self.servingId = s['serving_id']
+        self.description = s.get('serving_description', '')
+        self.metricUnit = s.get('metric_serving_unit', '')
+        self.numberOfUnits = float(s.get('number_of_units', 1))
+        self.metricAmount = None
+        if 'metric_serving_amount' in s:
+            self.metricAmount = float(s['metric_serving_amount'])
+        self.calories = self.perGram(s, 'calories')
+        self.carbohydrate = self.perGram(s, 'carbohydrate')
+        self.protein = self.perGram(s, 'protein')
+        self.fat = self.perGram(s, 'fat')
+
+    def perGram(self, s, key):
+        if key not in s or not self.metricAmount:
+            return None
+        return float(s[key]) / self.metricAmount
+
+    def __repr__(self):
+        return 'Serving(%s, %s)' % (self.servingId, self.description)
+
+
+class Food():
+    __slots__ = ('foodId', 'foodName', 'brandName', 'servings')
+
+    def __init__(self, foodId, foodName, brandName, servings):
+        self.foodId = foodId
+        self.foodName = foodName
+        self.brandName = brandName
+        self.servings = servings
+
+    @classmethod
+    def fromApi(cls, f):
+        servings = f['servings']
+        if type(servings) is dict:
+            servings = servings['serving']
+        if type(servings) is dict:
+            servings = [servings]
+        return cls(f['food_id'], f['food_name'], f.get('brand_name'),
+                   tuple(Serving(s) for s in servings))
+
+    def __repr__(self):
+        return 'Food(%s, %s)' % (self.foodId, self.displayName())
+
+    def displayName(self):
+        if self.brandName:
+            return self.brandName + ' ' + self.foodName
+        return self.foodName
+
+    def serving(self, servingId):
+        for s in self.servings:
+            if s.servingId == servingId:
+                return s
+        return None
+
+    def sizeOf(self):
+        size = sys.getsizeof(self) + sys.getsizeof(self.servings)
+        size += sys.getsizeof(self.foodId) + sys.getsizeof(self.foodName)
+        size += sys.getsizeof(self.brandName)
+        for s in self.servings:
+            size += sys.getsizeof(s)
+            for a in Serving.__slots__:
+                size += sys.getsizeof(getattr(s, a))
+        return size
+
+
+class FoodStore():
+    # least recently used foods are evicted once maxFoods is reached
+    # shared between the gui and the fatsecret threads, so locked
+
+    def __init__(self, maxFoods=200):
+        self.maxFoods = maxFoods
+        self.foods = collections.OrderedDict()
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    def get(self, foodId):
+        with self.lock:
+            food = self.foods.get(foodId)
+            if food is not None:
+                self.foods.move_to_end(foodId)
+            return food
+
+    def put(self, food):
+        with self.lock:
+            self.foods[food.foodId] = food
+            self.foods.move_to_end(food.foodId)
+            while len(self.foods) > self.maxFoods:
+                self.foods.popitem(last=False)
+                self.evictions += 1
+
+    def __contains__(self, foodId):
+        with self.lock:
+            return foodId in self.foods
+
+    def __len__(self):
+        with self.lock:
+            return len(self.foods)
+
+    def memoryUsage(self):
+        with self.lock:
+            size = sys.getsizeof(self.foods)
+            for food in self.foods.values():
+                size += food.sizeOf()
+            return {'foods': len(self.foods), 'maxFoods': self.maxFoods,
+                    'evictions': self.evictions, 'bytes': size}
+
+
+class History():
+    # local copy of food entries and weigh events, keyed by date
+    # only to be used from the thread that created it (sqlite)
+
+    nutrients = ('calories', 'protein', 'fat', 'carbohydrate')
+    entryColumns = ('date', 'food_entry_id', 'food_id', 'meal',
+                    'food_entry_name', 'serving_id', 'number_of_units',
+                    'calories', 'protein', 'fat', 'carbohydrate')
+    weighColumns = ('time', 'date', 'food_entry_id', 'food_id', 'meal',
+                    'grams')
+    dailyColumns = ('date', 'entries', 'calories', 'protein', 'fat',
+                    'carbohydrate')
+
+    def __init__(self, filename="PiFoodScale.db"):
+        self.db = sqlite3.connect(filename)
+        self.db.executescript("""
+            CREATE TABLE IF NOT EXISTS entries (
+                date TEXT NOT NULL,
+                food_entry_id TEXT PRIMARY KEY,
+                food_id TEXT NOT NULL,
+                meal TEXT,
+                food_entry_name TEXT,
+                serving_id TEXT,
+                number_of_units REAL,
+                calories REAL,
+                protein REAL,
+                fat REAL,
+                carbohydrate REAL);
+            CREATE INDEX IF NOT EXISTS entries_date
+                ON entries (date, meal);
+            CREATE INDEX IF NOT EXISTS entries_food
+                ON entries (food_id, date);
+            CREATE TABLE IF NOT EXISTS weighs (
+                time TEXT NOT NULL,
+                date TEXT NOT NULL,
+                food_entry_id TEXT,
+                food_id TEXT NOT NULL,
+                meal TEXT,
+                grams REAL);
+            CREATE INDEX IF NOT EXISTS weighs_date
+                ON weighs (date, meal);
+            CREATE INDEX IF NOT EXISTS weighs_food
+                ON weighs (food_id, date);
+            CREATE TABLE IF NOT EXISTS daily (
+                date TEXT PRIMARY KEY,
+                entries INTEGER,
+                calories REAL,
+                protein REAL,
+                fat REAL,
+                carbohydrate REAL);
+            """)
+        self.db.commit()
+
+    @staticmethod
+    def dateKey(date):
+        if isinstance(date, datetime.datetime):
+            date = date.date()
+        if isinstance(date, datetime.date):
+            return date.isoformat()
+        return date
+
+    @staticmethod
+    def number(value):
+        if value is None:
+            return None
+        return float(value)
+
+    def syncEntries(self, date, entries):
+        # entries is the full list from food_entries_get for this date
+        date = self.dateKey(date)
+        with self.db:
+            self.db.execute("DELETE FROM entries WHERE date = ?", (date,))
+            self.db.executemany(
+                "INSERT OR REPLACE INTO entries VALUES "
+                "(?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                [(date, e['food_entry_id'], e['food_id'], e.get('meal'),
+                  e.get('food_entry_name'), e.get('serving_id'),
+                  self.number(e.get('number_of_units')),
+                  self.number(e.get('calories')),
+                  self.number(e.get('protein')),
+                  self.number(e.get('fat')),
+                  self.number(e.get('carbohydrate')))
+                 for e in entries])
+            self.rollup(date)
+
+    def deleteEntry(self, food_entry_id):
+        with self.db:
+            row = self.db.execute(
+                "SELECT date FROM entries WHERE food_entry_id = ?",
+                (food_entry_id,)).fetchone()
+            if row is None:
+                return
+            self.db.execute("DELETE FROM entries WHERE food_entry_id = ?",
+                            (food_entry_id,))
+            self.rollup(row[0])
+
+    def addWeigh(self, time, food_id, meal, grams, food_entry_id=None):
+        with self.db:
+            self.db.execute(
+                "INSERT INTO weighs VALUES (?, ?, ?, ?, ?, ?)",
+                (time.isoformat(), self.dateKey(time), food_entry_id,
+                 food_id, meal, grams))
+
+    def rollup(self, date):
+        self.db.execute(
+            "INSERT OR REPLACE INTO daily "
+            "SELECT ?, COUNT(*), TOTAL(calories), TOTAL(protein), "
+            "TOTAL(fat), TOTAL(carbohydrate) FROM entries WHERE date = ?",
+            (date, date))
+
+    def rangeQuery(self, table, columns, start, end, food_id=None,
+                   meal=None):
+        sql = "SELECT %s FROM %s WHERE date >= ? AND date <= ?" % (
+            ', '.join(columns), table)
+        args = [self.dateKey(start), self.dateKey(end)]
+        if food_id is not None:
+            sql += " AND food_id = ?"
+            args.append(food_id)
+        if meal is not None:
+            sql += " AND meal = ?"
+            args.append(meal)
+        return self.db.execute(sql + " ORDER BY date", args)
+
+    def entries(self, start, end, food_id=None, meal=None):
+        return self.rangeQuery('entries', self.entryColumns, start, end,
+                               food_id, meal)
+
+    def weighs(self, start, end, food_id=None, meal=None):
+        return self.rangeQuery('weighs', self.weighColumns, start, end,
+                               food_id, meal)
+
+    def daily(self, start, end):
+        return self.rangeQuery('daily', self.dailyColumns, start, end)
+
+    def mealTotals(self, start, end):
+        return self.db.execute(
+            "SELECT date, meal, COUNT(*), TOTAL(calories), TOTAL(protein), "
+            "TOTAL(fat), TOTAL(carbohydrate) FROM entries "
+            "WHERE date >= ? AND date <= ? GROUP BY date, meal "
+            "ORDER BY date, meal", (self.dateKey(start), self.dateKey(end)))
+
+    def export(self, filename, table='entries', start='0000-00-00',
+               end='9999-99-99', batch=1000):
+        columns = {'entries': self.entryColumns,
+                   'weighs': self.weighColumns,
+                   'daily': self.dailyColumns}[table]
+        cursor = self.rangeQuery(table, columns, start, end)
+        if filename.endswith('.parquet'):
+            self.exportParquet(filename, table, columns, cursor, batch)
+        else:
+            with open(filename, 'w', newline='') as f:
+                w = csv.writer(f)
+                w.writerow(columns)
+                rows = cursor.fetchmany(batch)
+                while rows:
+                    w.writerows(rows)
+                    rows = cursor.fetchmany(batch)
+
+    def exportParquet(self, filename, table, columns, cursor, batch):
+        import pyarrow
+        import pyarrow.parquet
+        # one fixed schema from the declared column types, otherwise a
+        # batch with an all NULL column is typed null and won't write
+        types = {'TEXT': pyarrow.string(), 'REAL': pyarrow.float64(),
+                 'INTEGER': pyarrow.int64()}
+        declared = dict((row[1], row[2]) for row in
+                        self.db.execute("PRAGMA table_info(%s)" % table))
+        schema = pyarrow.schema([(c, types[declared[c]]) for c in columns])
+        writer = pyarrow.parquet.ParquetWriter(filename, schema)
+        try:
+            rows = cursor.fetchmany(batch)
+            while rows:
+                writer.write_table(pyarrow.Table.from_pydict(
+                    dict(zip(columns, map(list, zip(*rows)))),
+                    schema=schema))
+                rows = cursor.fetchmany(batch)
+        finally:
+            writer.close()
+
+    def close(self):
+        self.db.close()
+
+
 class FatSecretApi(QObject):
 
     q = queue.Queue()
@@ -558,9 +1102,17 @@ class FatSecretApi(QObject):
     def __init__(self, config):
         super().__init__()
         self.fsConfig = config.config['Apis']['FatSecret']
-        self.foods = {}
+        self.foods = FoodStore(config.config['FoodStore']['MaxFoods'])
+        self.historyFile = config.config['History']['Filename']
+        self.history = None
 
     def run(self):
+        # sqlite connections belong to the thread that opens them
+        try:
+            self.history = History(self.historyFile)
+        except Exception:
+            logging.exception('History open exception:')
+            self.history = None
         while(True):
             item = self.q.get()
             self.dispatch(item)
@@ -579,6 +1131,10 @@ class FatSecretApi(QObject):
             self.food_entry_create(item)
         elif item['func'] == 'food_entry_delete':
             self.food_entry_delete(item)
+        elif item['func'] == 'food_get':
+            self.food_get(item)
+        elif item['func'] == 'history_export':
+            self.history_export(item)
 
     onLogin = pyqtSignal(dict)
 
@@ -594,6 +1150,37 @@ class FatSecretApi(QObject):
             self.onLogin.emit(
                 {'login': False, 'error': type(e).__name__ + ': ' + str(e)})
 
+    def getFood(self, food_id):
+        food = self.foods.get(food_id)
+        if food is None:
+            food = Food.fromApi(self.fs.food_get(food_id))
+            self.foods.put(food)
+        return food
+
+    onFood = pyqtSignal(dict)
+
+    def food_get(self, params):
+        # the fetched food is handed over directly, so it is selected even
+        # if the store evicts it again straight away
+        try:
+            food = Food.fromApi(self.fs.food_get(params['food_id']))
+            self.foods.put(food)
+            self.onFood.emit({'data': food,
+                              'selection': params['selection']})
+        except Exception as e:
+            logging.exception('Fatsecret food_get exception:')
+            self.onFood.emit({'error': type(e).__name__ + ': ' + str(e),
+                              'selection': params['selection']})
+
+    def updateHistory(self, func, *args):
+        # the history is only a local copy, never let it fail an api call
+        if self.history is None:
+            return
+        try:
+            getattr(self.history, func)(*args)
+        except Exception:
+            logging.exception('History %s exception:', func)
+
     onEaten = pyqtSignal(dict)
 
     def get_eaten(self, params):
@@ -603,12 +1190,9 @@ class FatSecretApi(QObject):
                 result = []
             result3 = []
             for f in result:
-                if f['food_id'] in self.foods:
-                    result2 = self.foods[f['food_id']]
-                else:
-                    result2 = self.fs.food_get(f['food_id'])
-                self.foods[f['food_id']] = result2
+                result2 = self.getFood(f['food_id'])
                 result3.append(result2)
+            logging.info('food store %s', self.foods.memoryUsage())
             self.onEaten.emit({'data': result3})
         except Exception as e:
             logging.exception('Fatsecret get_eaten exception:')
@@ -623,12 +1207,10 @@ class FatSecretApi(QObject):
                 result = []
             result3 = []
             for f in result:
-                if f['food_id'] in self.foods:
-                    result2 = self.foods[f['food_id']]
-                else:
-                    result2 = self.fs.food_get(f['food_id'])
-                self.foods[f['food_id']] = result2
+                result2 = self.getFood(f['food_id'])
                 result3.append({'entry': f, 'food': result2})
+            self.updateHistory('syncEntries', params['date'], result)
+            logging.info('food store %s', self.foods.memoryUsage())
             self.onEntries.emit({'data': result3})
         except Exception as e:
             logging.exception('Fatsecret get_entries exception:')
@@ -647,6 +1229,12 @@ class FatSecretApi(QObject):
                 date=params['date'])
             if result is None:
                 result = []
+            food_entry_id = None
+            if isinstance(result, (str, int)):
+                food_entry_id = str(result)
+            self.updateHistory('addWeigh', params['date'], params['food_id'],
+                               params['meal'], params.get('grams'),
+                               food_entry_id)
             self.onFoodEntryCreate.emit({'data': result})
         except Exception as e:
             logging.exception('Fatsecret food_entry_create exception:')
@@ -661,12 +1249,25 @@ class FatSecretApi(QObject):
                 food_entry_id=params['food_entry_id'])
             if result is None:
                 result = []
+            self.updateHistory('deleteEntry', params['food_entry_id'])
             self.onFoodEntryCreate.emit({'data': result})
         except Exception as e:
             logging.exception('Fatsecret food_entry_delete exception:')
             self.onFoodEntryDelete.emit(
                 {'error': type(e).__name__ + ': ' + str(e)})
 
+    def history_export(self, params):
+        if self.history is None:
+            logging.info('history_export: no history available')
+            return
+        try:
+            self.history.export(params['filename'],
+                                params.get('table', 'entries'),
+                                params.get('start', '0000-00-00'),
+                                params.get('end', '9999-99-99'))
+        except Exception:
+            logging.exception('history_export exception:')
+
 
 if __name__ == '__main__':
     fmt = logging.Formatter('%(asctime)s %(message)s')